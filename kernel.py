@@ -1,27 +1,65 @@
 import os
+import pathlib
+import re
 import time
 import subprocess
+import shlex
+import shutil
 import json
+import orjson
 import inspect
-from typing import Dict, Any, List, Optional, Callable, Union, get_origin, get_args
-from openai import OpenAI
+import hashlib
+import math
+import functools
+import atexit
+import select
+import socket
+import http.client
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    Dict,
+    Any,
+    List,
+    Optional,
+    Callable,
+    Tuple,
+    Union,
+    get_origin,
+    get_args,
+)
 import sanitizer
-from dotenv import load_dotenv
 
 # --- CONFIGURATION ---
 ADB_PATH = "adb"
+SHELL_TIMEOUT = 30
 MODEL = "gpt-5.2-2025-12-11"
+PROMPTS_DIR = pathlib.Path(__file__).resolve().parent / "prompts"
+SCREEN_STATE_PREFIX = "Current screen state:"
+STALE_SCREEN_STATE = f"{SCREEN_STATE_PREFIX} (superseded by a newer screen state)"
+MAX_HISTORY_TURNS = 2
+MAX_UNCHANGED_SKIPS = 2
+TASK_COMPLETE = "TASK_COMPLETE"
+MINITOUCH_PATH = "/data/local/tmp/minitouch"
+MINITOUCH_PORT = 1111
+ATX_AGENT_PATH = "/data/local/tmp/atx-agent"
+ATX_AGENT_PORT = 7912
 SCREEN_DUMP_PATH = "/sdcard/window_dump.xml"
-LOCAL_DUMP_PATH = "window_dump.xml"
+HIERARCHY_ROTATION_RE = re.compile(r'<hierarchy\b[^>]*\srotation="(\d)"')
+
+
+@functools.lru_cache(maxsize=1)
+def get_client():
+    # Imported lazily: openai is slow to import and only needed to run the agent.
+    from openai import OpenAI
 
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 
 class FunctionRegistry:
     def __init__(self):
         self.functions: Dict[str, Callable] = {}
-        self.schemas: List[Dict[str, Any]] = []
+        self.schemas: Dict[str, Dict[str, Any]] = {}
 
     def _get_type_schema(self, annotation: Any) -> Dict[str, Any]:
         origin = get_origin(annotation)
@@ -87,14 +125,14 @@ class FunctionRegistry:
     def register(self, description: str):
         def decorator(func: Callable):
             self.functions[func.__name__] = func
-            schema = self._generate_schema(func, description)
-            self.schemas.append(schema)
+            # Keyed by name so re-registering replaces rather than duplicates.
+            self.schemas[func.__name__] = self._generate_schema(func, description)
             return func
 
         return decorator
 
     def get_functions(self) -> List[Dict[str, Any]]:
-        return self.schemas
+        return list(self.schemas.values())
 
     def get_function_map(self) -> Dict[str, Callable]:
         return self.functions
@@ -103,20 +141,28 @@ class FunctionRegistry:
 registry = FunctionRegistry()
 
 
+_ADB_ESCAPE = str.maketrans(
+    {
+        "\\": "\\\\",
+        " ": "%s",
+        "&": "\\&",
+        "<": "\\<",
+        ">": "\\>",
+        "|": "\\|",
+        ";": "\\;",
+        "$": "\\$",
+        "`": "\\`",
+        "(": "\\(",
+        ")": "\\)",
+        "'": "\\'",
+        '"': '\\"',
+        "#": "\\#",
+    }
+)
+
+
 def escape_text_for_adb(text: str) -> str:
-    text = text.replace(" ", "%s")
-    text = text.replace("&", "\\&")
-    text = text.replace("<", "\\<")
-    text = text.replace(">", "\\>")
-    text = text.replace("|", "\\|")
-    text = text.replace(";", "\\;")
-    text = text.replace("$", "\\$")
-    text = text.replace("`", "\\`")
-    text = text.replace("(", "\\(")
-    text = text.replace(")", "\\)")
-    text = text.replace("'", "\\'")
-    text = text.replace('"', '\\"')
-    return text
+    return text.translate(_ADB_ESCAPE)
 
 
 def run_adb_command(command: List[str]):
@@ -126,74 +172,514 @@ def run_adb_command(command: List[str]):
     return result.stdout.strip()
 
 
+class AdbShell:
+    """
+    Long-lived `adb shell` coprocess. Commands are written to its stdin and
+    their output is read back up to a sentinel line carrying the exit code,
+    so each call skips the adb CLI startup cost of a fresh subprocess.
+    """
+
+    SENTINEL = "__END__"
+
+    def __init__(self, adb_path: str = ADB_PATH):
+        self.adb_path = adb_path
+        self.proc: Optional[subprocess.Popen] = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        self.proc = subprocess.Popen(
+            [self.adb_path, "shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+        )
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def run_shell(
+        self, command: str, timeout: float = SHELL_TIMEOUT
+    ) -> Tuple[str, int]:
+        marker = f"\n{self.SENTINEL}".encode()
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self._start()
+
+            # The sentinel runs as its own shell line so nothing in the command
+            # (a comment, a trailing backslash) can swallow it. The leading
+            # newline keeps it on its own output line even when the command
+            # output does not end with one.
+            line = f"{command}\nprintf '\\n{self.SENTINEL}%d\\n' $?\n"
+            try:
+                self.proc.stdin.write(line.encode("utf-8"))
+            except (BrokenPipeError, OSError) as e:
+                self.close()
+                print(f"ADB Error: {e}")
+                return "", -1
+
+            # Read against a deadline: malformed input (an unbalanced quote)
+            # leaves the shell waiting for more and the sentinel never comes.
+            # Killing the shell lets the next call start a fresh one.
+            fd = self.proc.stdout.fileno()
+            deadline = time.monotonic() + timeout
+            buffer = bytearray()
+            while True:
+                index = buffer.find(marker)
+                end = buffer.find(b"\n", index + len(marker)) if index != -1 else -1
+                if end != -1:
+                    code = int(buffer[index + len(marker) : end] or -1)
+                    del buffer[index:]
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                    error = f"shell command timed out after {timeout:g}s"
+                    chunk = None
+                else:
+                    chunk = os.read(fd, 65536)
+                    error = None if chunk else "shell exited unexpectedly"
+                if error:
+                    self.close()
+                    print(f"ADB Error: {error}")
+                    return buffer.decode("utf-8", "replace").strip(), -1
+                buffer += chunk
+
+        output = buffer.decode("utf-8", "replace").strip()
+        if code != 0 and "error" in output.lower():
+            print(f"ADB Error: {output}")
+        return output, code
+
+
+adb_shell = AdbShell()
+atexit.register(adb_shell.close)
+
+
+class Minitouch:
+    """
+    Client for the minitouch touch daemon, reached through an adb port
+    forward. Touches are written to a persistent socket instead of forking
+    `input` on the device. `available()` is False when minitouch is not
+    installed or does not answer, and callers fall back to `input`.
+    """
+
+    PRESSURE = 50
+
+    def __init__(self, port: int = MINITOUCH_PORT):
+        self.port = port
+        self.sock: Optional[socket.socket] = None
+        self.lock = threading.Lock()
+        self.checked = False
+        self.scale_x = 1.0
+        self.scale_y = 1.0
+        self.pressure = self.PRESSURE
+
+    def _connect(self) -> bool:
+        try:
+            sock = socket.create_connection(("127.0.0.1", self.port), timeout=2)
+        except OSError:
+            return False
+
+        # Banner lines: "v <version>", "^ <contacts> <max-x> <max-y> <max-pressure>"
+        # and "$ <pid>". An empty banner means nothing listens behind the forward.
+        max_x = max_y = max_pressure = None
+        try:
+            for raw in sock.makefile("rb"):
+                fields = raw.decode().split()
+                if fields and fields[0] == "^":
+                    max_x, max_y, max_pressure = map(int, fields[2:5])
+                elif fields and fields[0] == "$":
+                    break
+        except (OSError, ValueError):
+            pass
+        if max_x is None:
+            sock.close()
+            return False
+
+        sock.settimeout(None)
+        width, height = screen_size()
+        if width and height:
+            self.scale_x = max_x / width
+            self.scale_y = max_y / height
+        self.pressure = min(self.PRESSURE, max_pressure)
+        self.sock = sock
+        return True
+
+    def available(self) -> bool:
+        with self.lock:
+            if not self.checked:
+                self.checked = True
+                run_adb_command(
+                    ["forward", f"tcp:{self.port}", "localabstract:minitouch"]
+                )
+                if not self._connect():
+                    adb_shell.run_shell(
+                        f"[ -x {MINITOUCH_PATH} ] && "
+                        f"({MINITOUCH_PATH} >/dev/null 2>&1 &)"
+                    )
+                    time.sleep(0.5)
+                    if not self._connect():
+                        print("minitouch unavailable, using input commands")
+            return self.sock is not None
+
+    def _send(self, commands: str):
+        # Steps built before an earlier write failed still land here.
+        if self.sock is None:
+            raise OSError("minitouch connection is closed")
+        try:
+            self.sock.sendall(commands.encode())
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+
+    def _point(self, x: int, y: int) -> str:
+        return f"{round(x * self.scale_x)} {round(y * self.scale_y)} {self.pressure}"
+
+    def tap(self, x: int, y: int):
+        with self.lock:
+            self._send(f"d 0 {self._point(x, y)}\nc\nu 0\nc\n")
+
+    def swipe(self, x1: int, y1: int, x2: int, y2: int, duration_ms: int):
+        steps = max(duration_ms // 16, 1)
+        with self.lock:
+            self._send(f"d 0 {self._point(x1, y1)}\nc\n")
+            for i in range(1, steps + 1):
+                time.sleep(duration_ms / 1000 / steps)
+                x = x1 + (x2 - x1) * i // steps
+                y = y1 + (y2 - y1) * i // steps
+                self._send(f"m 0 {self._point(x, y)}\nc\n")
+            self._send("u 0\nc\n")
+
+
+minitouch = Minitouch()
+
+
+class AtxAgent:
+    """
+    Client for uiautomator2's atx-agent, reached through an adb port forward.
+    The agent keeps the UiAutomator service resident, so a hierarchy dump is
+    an HTTP round trip instead of a fresh `uiautomator` process per frame.
+    `available()` is False when the agent is not installed or does not
+    answer, and callers fall back to `uiautomator dump`.
+    """
+
+    def __init__(self, port: int = ATX_AGENT_PORT):
+        self.port = port
+        self.conn: Optional[http.client.HTTPConnection] = None
+        self.lock = threading.Lock()
+        self.checked = False
+        self.ready = False
+
+    def _request(self, method: str, path: str, body: Optional[bytes] = None) -> bytes:
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        headers = {"Content-Type": "application/json"} if body else {}
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.conn.close()
+            self.conn = None
+            # Callers treat any transport failure as OSError and fall back.
+            if isinstance(e, OSError):
+                raise
+            raise OSError(f"atx-agent {path} failed: {e!r}") from e
+        if response.status != 200:
+            raise OSError(f"atx-agent {path} returned HTTP {response.status}")
+        return data
+
+    def _connect(self) -> bool:
+        try:
+            self._request("GET", "/version")
+            self._request("POST", "/services/uiautomator")
+            return True
+        except OSError:
+            return False
+
+    def available(self) -> bool:
+        with self.lock:
+            if not self.checked:
+                self.checked = True
+                run_adb_command(["forward", f"tcp:{self.port}", f"tcp:{self.port}"])
+                self.ready = self._connect()
+                if not self.ready:
+                    adb_shell.run_shell(
+                        f"[ -x {ATX_AGENT_PATH} ] && {ATX_AGENT_PATH} server -d"
+                    )
+                    time.sleep(1)
+                    self.ready = self._connect()
+                if not self.ready:
+                    print("atx-agent unavailable, using uiautomator dump")
+            return self.ready
+
+    def dump_hierarchy(self) -> str:
+        body = orjson.dumps(
+            {
+                "jsonrpc": "2.0",
+                "id": 1,
+                "method": "dumpWindowHierarchy",
+                "params": [False],
+            }
+        )
+        with self.lock:
+            reply = orjson.loads(self._request("POST", "/jsonrpc/0", body))
+        if reply.get("result") is None:
+            raise OSError(f"dumpWindowHierarchy failed: {reply.get('error')}")
+        return reply["result"]
+
+
+atx_agent = AtxAgent()
+
+
+def screen_size() -> Tuple[int, int]:
+    # "Physical size: WxH", followed by "Override size: WxH" when one is set.
+    output, _ = adb_shell.run_shell("wm size")
+    sizes = re.findall(r"(\d+)x(\d+)", output)
+    if not sizes:
+        return 0, 0
+    width, height = sizes[-1]
+    return int(width), int(height)
+
+
+# Center coordinates of the elements in the latest screen state, by element id.
+element_centers: Dict[str, Tuple[int, int]] = {}
+# Display rotation of the latest screen state (0 is the natural orientation),
+# or None before the first capture or if the dump did not report it.
+screen_rotation: Optional[int] = None
+
+
+def can_use_minitouch() -> bool:
+    # minitouch works in the natural orientation, but coordinates from the UI
+    # dump follow the current rotation, so only use it when the two agree.
+    return screen_rotation == 0 and minitouch.available()
+
+
+# A device step is either a shell command or a host-side callable (a
+# minitouch write). Consecutive shell commands are sent as one pipeline.
+DeviceStep = Union[str, Callable[[], None]]
+
+
+def _tap_step(x: int, y: int) -> DeviceStep:
+    if not can_use_minitouch():
+        return f"input tap {x} {y}"
+
+    def tap():
+        try:
+            minitouch.tap(x, y)
+        except OSError:
+            adb_shell.run_shell(f"input tap {x} {y}")
+
+    return tap
+
+
+def _swipe_step(x1: int, y1: int, x2: int, y2: int, duration_ms: int) -> DeviceStep:
+    if not can_use_minitouch():
+        return f"input swipe {x1} {y1} {x2} {y2} {duration_ms}"
+
+    def swipe():
+        try:
+            minitouch.swipe(x1, y1, x2, y2, duration_ms)
+        except OSError:
+            adb_shell.run_shell(f"input swipe {x1} {y1} {x2} {y2} {duration_ms}")
+
+    return swipe
+
+
+def dump_ui_hierarchy() -> str:
+    if atx_agent.available():
+        try:
+            return atx_agent.dump_hierarchy()
+        except (OSError, ValueError) as e:
+            print(f"atx-agent dump failed, using uiautomator dump: {e}")
+
+    # The shell has no controlling terminal, so /dev/tty is unavailable; dump to
+    # a file and read it back in the same round trip instead of an adb pull.
+    output, _ = adb_shell.run_shell(
+        f"uiautomator dump {SCREEN_DUMP_PATH} >/dev/null && cat {SCREEN_DUMP_PATH}"
+    )
+    return output
+
+
 def get_screen_state() -> str:
-    run_adb_command(["shell", "uiautomator", "dump", SCREEN_DUMP_PATH])
-    run_adb_command(["pull", SCREEN_DUMP_PATH, LOCAL_DUMP_PATH])
+    xml_content = dump_ui_hierarchy().strip()
 
-    if not os.path.exists(LOCAL_DUMP_PATH):
+    if not xml_content.startswith("<"):
         return "Error: Could not capture screen."
 
-    with open(LOCAL_DUMP_PATH, "r", encoding="utf-8") as f:
-        xml_content = f.read()
-
+    global element_centers, screen_rotation
+    # The root element carries the rotation, e.g. <hierarchy rotation="0">.
+    match = HIERARCHY_ROTATION_RE.search(xml_content, 0, 512)
+    screen_rotation = int(match.group(1)) if match else None
     elements = sanitizer.get_interactive_elements(xml_content)
-    return json.dumps(elements, indent=2)
+    screen_text, element_centers = sanitizer.format_elements(elements)
+    return screen_text or "(no interactive elements)"
+
+
+def resolve_point(
+    x: Optional[int], y: Optional[int], element: Optional[str]
+) -> Tuple[int, int]:
+    if element:
+        if element not in element_centers:
+            raise ValueError(f"Unknown element {element} on the current screen")
+        return element_centers[element]
+    if x is None or y is None:
+        raise ValueError("Provide an element id or both x and y coordinates")
+    # Coordinates end up in device shell commands, so they must be plain ints.
+    return int(x), int(y)
+
+
+# Android action builders. Each returns the device steps for an action,
+# settle delay included, plus its result so that consecutive actions can be
+# sent to the device as one pipeline.
+def _tap_action(
+    x: Optional[int] = None, y: Optional[int] = None, element: Optional[str] = None
+) -> Tuple[List[DeviceStep], str]:
+    x, y = resolve_point(x, y, element)
+    print(f"Tapping: ({x}, {y})")
+    return [_tap_step(x, y), "sleep 0.5"], f"Tapped at ({x}, {y})"
+
+
+def _type_action(
+    text: str,
+    x: Optional[int] = None,
+    y: Optional[int] = None,
+    element: Optional[str] = None,
+) -> Tuple[List[DeviceStep], str]:
+    commands = []
+    if element or (x is not None and y is not None):
+        x, y = resolve_point(x, y, element)
+        print(f"Focusing text field at: ({x}, {y})")
+        commands += [_tap_step(x, y), "sleep 0.5"]
 
+    print(f"Typing: {text}")
+    escaped_text = escape_text_for_adb(text)
+    commands += [f"input text {escaped_text}", "sleep 0.3"]
+    return commands, f"Typed: {text}"
+
+
+# Fixed steps and results are shared rather than rebuilt per call; callers
+# only ever copy the step lists.
+_HOME_STEPS: List[DeviceStep] = ["input keyevent KEYCODE_HOME", "sleep 0.5"]
+_HOME_RESULT = "Navigated to home screen"
+_BACK_STEPS: List[DeviceStep] = ["input keyevent KEYCODE_BACK", "sleep 0.5"]
+_BACK_RESULT = "Went back"
 
-# Android action functions
-@registry.register("Tap on the Android screen at the given coordinates")
-def android_tap(x: int, y: int) -> str:
-    print(f"Tapping: ({x}, {y})")
-    run_adb_command(["shell", "input", "tap", str(x), str(y)])
-    time.sleep(0.5)
-    return f"Tapped at ({x}, {y})"
 
+def _home_action() -> Tuple[List[DeviceStep], str]:
+    print("Going Home")
+    return _HOME_STEPS, _HOME_RESULT
+
+
+def _back_action() -> Tuple[List[DeviceStep], str]:
+    print("Going Back")
+    return _BACK_STEPS, _BACK_RESULT
 
+
+def _swipe_action(
+    x1: int, y1: int, x2: int, y2: int, duration_ms: int = 300
+) -> Tuple[List[DeviceStep], str]:
+    x1, y1, x2, y2, duration_ms = map(int, (x1, y1, x2, y2, duration_ms))
+    print(f"Swiping from ({x1}, {y1}) to ({x2}, {y2})")
+    commands = [_swipe_step(x1, y1, x2, y2, duration_ms), "sleep 0.5"]
+    return commands, f"Swiped from ({x1}, {y1}) to ({x2}, {y2})"
+
+
+def _wait_action(seconds: float = 2.0) -> Tuple[List[DeviceStep], str]:
+    # The value ends up in a device shell command, so it must be a plain number.
+    seconds = float(seconds)
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(f"Invalid wait duration: {seconds}")
+    print(f"Waiting {seconds} seconds...")
+    return [f"sleep {seconds}"], f"Waited {seconds} seconds"
+
+
+def _run_pipeline(commands: List[str]):
+    # Device-side sleeps (settle delays, android_wait) extend the read deadline.
+    slept = sum(float(c.split()[1]) for c in commands if c.startswith("sleep "))
+    adb_shell.run_shell("; ".join(commands), timeout=SHELL_TIMEOUT + slept)
+
+
+def run_device_commands(commands: List[DeviceStep]):
+    pending: List[str] = []
+    for step in commands:
+        if isinstance(step, str):
+            pending.append(step)
+            continue
+        if pending:
+            _run_pipeline(pending)
+            pending = []
+        step()
+    if pending:
+        _run_pipeline(pending)
+
+
+# Android action functions
 @registry.register(
-    "Type text into the Android device. Optionally provide coordinates to focus a text field first."
+    "Tap on the Android screen. Provide an element id from the screen state, or coordinates."
 )
-def android_type(text: str, x: Optional[int] = None, y: Optional[int] = None) -> str:
-    if x is not None and y is not None:
-        print(f"Focusing text field at: ({x}, {y})")
-        run_adb_command(["shell", "input", "tap", str(x), str(y)])
-        time.sleep(0.5)
+def android_tap(
+    x: Optional[int] = None, y: Optional[int] = None, element: Optional[str] = None
+) -> str:
+    commands, result = _tap_action(x, y, element)
+    run_device_commands(commands)
+    return result
 
-    print(f"Typing: {text}")
-    escaped_text = escape_text_for_adb(text)
-    run_adb_command(["shell", "input", "text", escaped_text])
-    time.sleep(0.3)
-    return f"Typed: {text}"
+
+@registry.register(
+    "Type text into the Android device. Optionally provide an element id or coordinates to focus a text field first."
+)
+def android_type(
+    text: str,
+    x: Optional[int] = None,
+    y: Optional[int] = None,
+    element: Optional[str] = None,
+) -> str:
+    commands, result = _type_action(text, x, y, element)
+    run_device_commands(commands)
+    return result
 
 
 @registry.register("Navigate to the Android home screen")
 def android_home() -> str:
-    print("Going Home")
-    run_adb_command(["shell", "input", "keyevent", "KEYCODE_HOME"])
-    time.sleep(0.5)
-    return "Navigated to home screen"
+    commands, result = _home_action()
+    run_device_commands(commands)
+    return result
 
 
 @registry.register("Press the back button on Android")
 def android_back() -> str:
-    print("Going Back")
-    run_adb_command(["shell", "input", "keyevent", "KEYCODE_BACK"])
-    time.sleep(0.5)
-    return "Went back"
+    commands, result = _back_action()
+    run_device_commands(commands)
+    return result
 
 
 @registry.register("Swipe on the Android screen from start coordinates to end coordinates")
 def android_swipe(x1: int, y1: int, x2: int, y2: int, duration_ms: int = 300) -> str:
-    print(f"Swiping from ({x1}, {y1}) to ({x2}, {y2})")
-    run_adb_command(["shell", "input", "swipe", str(x1), str(y1), str(x2), str(y2), str(duration_ms)])
-    time.sleep(0.5)
-    return f"Swiped from ({x1}, {y1}) to ({x2}, {y2})"
+    commands, result = _swipe_action(x1, y1, x2, y2, duration_ms)
+    run_device_commands(commands)
+    return result
 
 
 @registry.register("Wait for a specified number of seconds")
 def android_wait(seconds: float = 2.0) -> str:
-    print(f"Waiting {seconds} seconds...")
-    time.sleep(seconds)
-    return f"Waited {seconds} seconds"
+    _, result = _wait_action(seconds)
+    time.sleep(float(seconds))
+    return result
+
+
+ANDROID_ACTIONS: Dict[str, Callable[..., Tuple[List[DeviceStep], str]]] = {
+    "android_tap": _tap_action,
+    "android_type": _type_action,
+    "android_home": _home_action,
+    "android_back": _back_action,
+    "android_swipe": _swipe_action,
+    "android_wait": _wait_action,
+}
 
 
 # Host-side functions
@@ -217,11 +703,35 @@ def host_write_file(filepath: str, content: str) -> str:
         return f"Error writing file: {str(e)}"
 
 
+# Commands using any of this syntax still need /bin/sh.
+SHELL_SYNTAX_RE = re.compile(r"[|&;<>()$`\\*?\[\]{}~#!=%\n]")
+
+
+def split_plain_command(command: str) -> Optional[List[str]]:
+    if SHELL_SYNTAX_RE.search(command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    # Builtins such as cd, type, exit or eval have no executable to run.
+    if not argv or shutil.which(argv[0]) is None:
+        return None
+    return argv
+
+
 @registry.register("Run a shell command on the host machine")
-def host_run_command(command: str) -> str:
+def host_run_command(command: Union[str, List[str]]) -> str:
     try:
+        # Plain "program arg ..." commands are executed directly, skipping the
+        # extra /bin/sh fork; anything else goes through the shell as before.
+        argv = command if isinstance(command, list) else split_plain_command(command)
         result = subprocess.run(
-            command, shell=True, capture_output=True, text=True, timeout=30
+            argv or command,
+            shell=argv is None,
+            capture_output=True,
+            text=True,
+            timeout=30,
         )
         output = result.stdout.strip()
         if result.stderr:
@@ -247,83 +757,461 @@ def host_list_directory(directory: str = ".") -> str:
 )
 def task_complete(summary: str) -> str:
     print(f"\n✓ Task Complete: {summary}")
-    return "TASK_COMPLETE"
+    return TASK_COMPLETE
 
 
-FUNCTIONS = registry.get_functions()
+# Round-trip through sorted JSON so every request sends byte-identical tool
+# definitions, which keeps them inside the provider's cached prompt prefix.
+FUNCTIONS = json.loads(json.dumps(registry.get_functions(), sort_keys=True))
 FUNCTION_MAP = registry.get_function_map()
 
+tool_executor = ThreadPoolExecutor(max_workers=1)
+host_executor = ThreadPoolExecutor(max_workers=4)
+# Host calls that can safely overlap. Writes and commands may depend on each
+# other (write a script, then run it), so they run alone in call order.
+READ_ONLY_HOST_FUNCTIONS = {"host_read_file", "host_list_directory"}
 
-def run_agent(goal: str, max_iterations: int = 50):
-    print(f"Android Agent Started. Goal: {goal}\n")
 
-    with open("prompts/agent_system_prompt.md", "r", encoding="utf-8") as f:
-        system_prompt = f.read().strip()
+@functools.lru_cache(maxsize=None)
+def load_prompt(name: str) -> str:
+    # Read once per process so every request sends byte-identical prompt text.
+    return (PROMPTS_DIR / name).read_text(encoding="utf-8").strip()
+
+
+SUBMIT_PLAN_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "submit_plan",
+        "description": "Submit the full sequence of function calls that achieves the goal.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "steps": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "action": {
+                                "type": "string",
+                                "description": "Name of the function to call",
+                            },
+                            "args": {
+                                "type": "object",
+                                "description": "Arguments for the function",
+                            },
+                            "target": {
+                                "type": "string",
+                                "description": "Label of the element to act on, looked up when the step runs",
+                            },
+                            "expect": {
+                                "type": "string",
+                                "description": "Label that must be on screen before the step runs",
+                            },
+                        },
+                        "required": ["action", "args"],
+                    },
+                }
+            },
+            "required": ["steps"],
+        },
+    },
+}
+
+
+def is_screen_state(msg: Any) -> bool:
+    return (
+        isinstance(msg, dict)
+        and msg["role"] == "user"
+        and msg["content"].startswith(SCREEN_STATE_PREFIX)
+    )
+
+
+def retire_screen_states(messages: List[Any]):
+    """
+    Replaces earlier screen dumps with a fixed placeholder. Only the newest
+    screen is relevant, and once a dump is retired its message never changes
+    again, so the cacheable prompt prefix keeps growing until the next
+    trim_history cut.
+    """
+    for msg in messages:
+        if is_screen_state(msg):
+            msg["content"] = STALE_SCREEN_STATE
+
+
+def trim_history(messages: List[Any], max_turns: int = MAX_HISTORY_TURNS):
+    """
+    Keeps the messages before the first screen state (system prompt and goal)
+    plus recent turns. A turn starts at a screen state message and owns the
+    assistant reply and tool results after it, so dropping whole turns never
+    leaves a tool result without its tool call.
+
+    History is cut back to the last `max_turns` turns only once it reaches
+    twice that, rather than dropping one turn per call. Between cuts the
+    history is only appended to, so the cached prompt prefix stays valid.
+    """
+    turn_starts = [i for i, msg in enumerate(messages) if is_screen_state(msg)]
+    if len(turn_starts) < 2 * max_turns:
+        return
+    head = messages[: turn_starts[0]]
+    messages[:] = head + messages[turn_starts[-max_turns] :]
+
+
+def call_function(function_name: str, function_args: Dict[str, Any]) -> str:
+    if function_name not in FUNCTION_MAP:
+        return f"Error: Unknown function {function_name}"
+    try:
+        return FUNCTION_MAP[function_name](**function_args)
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+
+def execute_tool_calls(
+    tool_calls: List[Dict[str, Any]]
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Runs the tool calls of one assistant turn in order and returns their tool
+    messages, plus whether task_complete was called. Consecutive android
+    actions are sent to the device as a single shell pipeline, and
+    consecutive read-only host calls run concurrently.
+    """
+    tool_messages = []
+    batch_commands: List[DeviceStep] = []
+    batch_results: List[Tuple[str, str]] = []
+    host_batch: List[Tuple[str, str, Dict[str, Any]]] = []
+
+    def add_result(tool_call_id: str, result: str):
+        tool_messages.append(
+            {"role": "tool", "tool_call_id": tool_call_id, "content": result}
+        )
+        print(f"Result: {result[:200]}...")
+
+    def flush_batch():
+        if batch_commands:
+            run_device_commands(batch_commands)
+        for tool_call_id, result in batch_results:
+            add_result(tool_call_id, result)
+        batch_commands.clear()
+        batch_results.clear()
+
+    def flush_host_batch():
+        if len(host_batch) > 1:
+            results = host_executor.map(
+                lambda call: call_function(call[1], call[2]), host_batch
+            )
+        else:
+            results = [call_function(name, args) for _, name, args in host_batch]
+        for (tool_call_id, _, _), result in zip(host_batch, results):
+            add_result(tool_call_id, result)
+        host_batch.clear()
+
+    for tool_call in tool_calls:
+        tool_call_id = tool_call["id"]
+        function_name = tool_call["function"]["name"]
+        function_args = orjson.loads(tool_call["function"]["arguments"] or "{}")
+
+        args_text = orjson.dumps(function_args, option=orjson.OPT_INDENT_2).decode()
+        print(f"Calling: {function_name}({args_text})")
+
+        if function_name in ANDROID_ACTIONS:
+            flush_host_batch()
+            try:
+                commands, result = ANDROID_ACTIONS[function_name](**function_args)
+            except Exception as e:
+                flush_batch()
+                add_result(tool_call_id, f"Error: {str(e)}")
+                continue
+            batch_commands.extend(commands)
+            batch_results.append((tool_call_id, result))
+            continue
+
+        flush_batch()
+        if function_name in READ_ONLY_HOST_FUNCTIONS:
+            host_batch.append((tool_call_id, function_name, function_args))
+            continue
+
+        flush_host_batch()
+        result = call_function(function_name, function_args)
+
+        if result == TASK_COMPLETE:
+            return tool_messages, True
+
+        add_result(tool_call_id, result)
+
+    flush_batch()
+    flush_host_batch()
+    return tool_messages, False
 
+
+class ToolCallRunner:
+    """
+    Executes tool calls on `tool_executor` as they finish streaming, in the
+    order they were submitted. Calls that arrive while earlier ones are still
+    running are picked up together, so they still share one device pipeline.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: List[Dict[str, Any]] = []
+        self.running = False
+        self.future: Optional[Future] = None
+        self.tool_messages: List[Dict[str, Any]] = []
+        self.completed = False
+
+    def submit(self, tool_call: Dict[str, Any]):
+        with self.lock:
+            self.pending.append(tool_call)
+            if not self.running:
+                self.running = True
+                self.future = tool_executor.submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                if not self.pending or self.completed:
+                    self.pending = []
+                    self.running = False
+                    return
+                tool_calls, self.pending = self.pending, []
+            try:
+                tool_messages, completed = execute_tool_calls(tool_calls)
+            except Exception:
+                with self.lock:
+                    self.pending = []
+                    self.running = False
+                raise
+            with self.lock:
+                self.tool_messages.extend(tool_messages)
+                self.completed = completed
+
+    def join(self) -> Tuple[List[Dict[str, Any]], bool]:
+        if self.future is not None:
+            self.future.result()
+        return self.tool_messages, self.completed
+
+
+def stream_assistant_turn(
+    messages: List[Dict[str, Any]]
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]], bool]:
+    """
+    Requests the next assistant message with streaming enabled and starts
+    each tool call as soon as its arguments are complete, while the rest of
+    the response is still being decoded. Returns the assembled assistant
+    message, the tool messages and whether task_complete was called.
+    """
+    response = get_client().chat.completions.create(
+        model=MODEL,
+        messages=messages,
+        tools=FUNCTIONS,
+        tool_choice="auto",
+        stream=True,
+    )
+
+    runner = ToolCallRunner()
+    content_parts: List[str] = []
+    tool_calls: Dict[int, Dict[str, Any]] = {}
+    dispatched = 0
+
+    for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+
+        if delta.content:
+            content_parts.append(delta.content)
+
+        for call_delta in delta.tool_calls or []:
+            if call_delta.index not in tool_calls:
+                # A new call starting means every earlier one is complete.
+                for index in sorted(tool_calls)[dispatched:]:
+                    runner.submit(tool_calls[index])
+                    dispatched += 1
+                tool_calls[call_delta.index] = {
+                    "id": "",
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""},
+                }
+            tool_call = tool_calls[call_delta.index]
+            if call_delta.id:
+                tool_call["id"] = call_delta.id
+            if call_delta.function is not None:
+                if call_delta.function.name:
+                    tool_call["function"]["name"] += call_delta.function.name
+                if call_delta.function.arguments:
+                    tool_call["function"]["arguments"] += call_delta.function.arguments
+
+    for index in sorted(tool_calls)[dispatched:]:
+        runner.submit(tool_calls[index])
+
+    message: Dict[str, Any] = {
+        "role": "assistant",
+        "content": "".join(content_parts) or None,
+    }
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+
+    tool_messages, completed = runner.join()
+    return message, tool_messages, completed
+
+
+def plan_actions(goal: str, screen_context: str) -> List[Dict[str, Any]]:
+    """
+    Asks the model once for the whole sequence of steps that achieves the
+    goal, each shaped like the items of SUBMIT_PLAN_TOOL.
+    """
+    response = get_client().chat.completions.create(
+        model=MODEL,
+        messages=[
+            {"role": "system", "content": load_prompt("agent_system_prompt.md")},
+            {"role": "user", "content": f"GOAL: {goal}"},
+            {"role": "user", "content": load_prompt("planner_prompt.md")},
+            {"role": "user", "content": f"{SCREEN_STATE_PREFIX}\n{screen_context}"},
+        ],
+        tools=FUNCTIONS + [SUBMIT_PLAN_TOOL],
+        tool_choice={"type": "function", "function": {"name": "submit_plan"}},
+    )
+
+    tool_calls = response.choices[0].message.tool_calls
+    if not tool_calls:
+        return []
+    plan = orjson.loads(tool_calls[0].function.arguments or "{}")
+    steps = plan.get("steps") if isinstance(plan, dict) else None
+    return steps if isinstance(steps, list) else []
+
+
+def execute_plan(
+    steps: List[Dict[str, Any]], screen_context: str
+) -> Tuple[bool, List[str], str]:
+    """
+    Runs a plan from plan_actions locally without calling the model. Before a
+    step with `expect` or `target`, the screen is captured again and checked.
+    Returns whether task_complete was reached, the results of the executed
+    steps, and why execution stopped early otherwise.
+    """
+    executed = []
+
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict) or not isinstance(step.get("args", {}), dict):
+            return False, executed, f"plan step {index + 1} is malformed"
+        action = step.get("action", "")
+        args = dict(step.get("args") or {})
+        expect = step.get("expect")
+        target = step.get("target")
+        print(f"\n--- Plan step {index + 1}/{len(steps)}: {action} ---")
+
+        if index > 0 and (expect or target):
+            time.sleep(1)
+            screen_context = get_screen_state()
+        if expect and sanitizer.find_element(screen_context, expect) is None:
+            return False, executed, f"expected '{expect}' on screen before {action}"
+        if target:
+            element = sanitizer.find_element(screen_context, target)
+            if element is None:
+                return False, executed, f"'{target}' not found on screen for {action}"
+            args["element"] = element
+
+        tool_call = {
+            "id": f"plan_{index}",
+            "function": {"name": action, "arguments": orjson.dumps(args).decode()},
+        }
+        tool_messages, completed = execute_tool_calls([tool_call])
+        if completed:
+            return True, executed, ""
+
+        result = tool_messages[0]["content"]
+        if result.startswith("Error"):
+            return False, executed, f"{action} failed: {result}"
+        executed.append(f"{action}: {result}")
+
+    return False, executed, "the plan ended without calling task_complete"
+
+
+def run_agent(goal: str, max_iterations: int = 50, plan: bool = False):
+    print(f"Android Agent Started. Goal: {goal}\n")
+
+    system_prompt = load_prompt("agent_system_prompt.md")
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": f"GOAL: {goal}"},
     ]
 
-    for iteration in range(max_iterations):
-        print(f"\n--- Iteration {iteration + 1} ---")
-
+    if plan:
         screen_context = get_screen_state()
+        steps = plan_actions(goal, screen_context)
+        completed, executed, reason = execute_plan(steps, screen_context)
+        if completed:
+            print("\n✓ Agent completed the task successfully!")
+            return
+
+        print(f"\nPlan stopped ({reason}), continuing step by step")
+        done = "\n".join(f"- {line}" for line in executed) or "- (none)"
         messages.append(
             {
                 "role": "user",
-                "content": f"Current screen state:\n{screen_context}",
+                "content": f"A planned run already executed these steps:\n{done}\n"
+                f"It stopped because {reason}. Continue from the current screen.",
             }
         )
 
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            tools=FUNCTIONS,
-            tool_choice="auto",
-        )
+    previous_hash: Optional[bytes] = None
+    unchanged_skips = 0
+    acted_on_device = False
 
-        message = response.choices[0].message
-        messages.append(message)
+    for iteration in range(max_iterations):
+        print(f"\n--- Iteration {iteration + 1} ---")
+
+        screen_context = get_screen_state()
 
-        if not message.tool_calls:
-            if message.content:
-                print(f"Agent: {message.content}")
+        # After a device action, an unchanged screen usually means the UI is
+        # still loading; wait rather than paying for a model call, but only a
+        # bounded number of times. Host-only or text-only turns leave the
+        # screen unchanged by design, so they never count as a stall.
+        screen_hash = hashlib.blake2b(screen_context.encode(), digest_size=16).digest()
+        if (
+            acted_on_device
+            and screen_hash == previous_hash
+            and unchanged_skips < MAX_UNCHANGED_SKIPS
+        ):
+            unchanged_skips += 1
+            print("Screen unchanged, waiting before asking the model again")
+            time.sleep(1)
             continue
+        previous_hash = screen_hash
+        unchanged_skips = 0
 
-        for tool_call in message.tool_calls:
-            function_name = tool_call.function.name
-            function_args = json.loads(tool_call.function.arguments)
+        retire_screen_states(messages)
+        messages.append(
+            {
+                "role": "user",
+                "content": f"{SCREEN_STATE_PREFIX}\n{screen_context}",
+            }
+        )
+        trim_history(messages)
 
-            print(f"Calling: {function_name}({json.dumps(function_args, indent=2)})")
+        message, tool_messages, completed = stream_assistant_turn(messages)
+        messages.append(message)
+        acted_on_device = any(
+            tool_call["function"]["name"] in ANDROID_ACTIONS
+            for tool_call in message.get("tool_calls", [])
+        )
 
-            if function_name not in FUNCTION_MAP:
-                result = f"Error: Unknown function {function_name}"
-            else:
-                try:
-                    result = FUNCTION_MAP[function_name](**function_args)
-                except Exception as e:
-                    result = f"Error: {str(e)}"
-
-            if result == "TASK_COMPLETE":
-                print("\n✓ Agent completed the task successfully!")
-                return
-
-            messages.append(
-                {
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": result,
-                }
-            )
+        if "tool_calls" not in message:
+            if message["content"]:
+                print(f"Agent: {message['content']}")
+            continue
 
-            print(f"Result: {result[:200]}...")
+        if completed:
+            print("\n✓ Agent completed the task successfully!")
+            return
 
+        messages.extend(tool_messages)
         time.sleep(1)
 
     print(f"\n⚠ Reached maximum iterations ({max_iterations})")
 
 
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
     GOAL = input("Enter your goal: ")
     run_agent(GOAL)
@@ -1,5 +1,5 @@
 import xml.etree.ElementTree as ET
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
 
 def get_interactive_elements(xml_content: str) -> List[Dict]:
@@ -65,3 +65,46 @@ def get_interactive_elements(xml_content: str) -> List[Dict]:
                 continue
 
     return elements
+
+
+def format_elements(elements: List[Dict]) -> Tuple[str, Dict[str, Tuple[int, int]]]:
+    """
+    Renders elements as one compact line each, "E<n>|<type>|<action>|<label>|<x>,<y>",
+    which costs far fewer tokens than the JSON form.
+    Also returns a lookup from element id to center coordinates, so actions can
+    refer to an element by id instead of repeating its coordinates.
+    """
+    lines = []
+    centers = {}
+
+    for index, element in enumerate(elements):
+        element_id = f"E{index}"
+        label = element["text"] or element["id"].split("/")[-1]
+        # Keep every element on a single line with an unambiguous field layout
+        label = " ".join(label.split()).replace("|", "/")[:32]
+        x, y = element["center"]
+
+        fields = [element_id, element["type"], element["action"], label, f"{x},{y}"]
+        lines.append("|".join(fields))
+        centers[element_id] = (x, y)
+
+    return "\n".join(lines), centers
+
+
+def find_element(screen_text: str, label: str) -> Optional[str]:
+    """
+    Looks up an element in a screen listing produced by format_elements by its
+    label. Only exact (case- and whitespace-insensitive) matches count, since a
+    near miss would act on the wrong element.
+    Returns the element id, or None if no element carries that label.
+    """
+    wanted = " ".join(label.split()).replace("|", "/").lower()[:32]
+    if not wanted:
+        return None
+
+    for line in screen_text.splitlines():
+        fields = line.split("|")
+        if len(fields) == 5 and fields[3].lower() == wanted:
+            return fields[0]
+
+    return None